@@ -3,14 +3,22 @@ Transperth Station Departure Scraper - FINAL VERSION
 Calls Transperth's official API directly - FREE and RELIABLE!
 """
 
-from flask import Flask, jsonify, request
+from flask import Flask, request
 from flask_cors import CORS
 import requests
-from bs4 import BeautifulSoup
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
 from datetime import datetime
 import re
-from urllib.parse import urlencode
+import gzip
+import heapq
+import os
+import logging
 import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 app = Flask(__name__)
 CORS(app)
@@ -24,10 +32,30 @@ except ImportError:
     from datetime import timezone, timedelta
     PERTH_TZ = timezone(timedelta(hours=8))
 
+# Log level - set DEBUG=1 for per-trip and raw response logging
+DEBUG = os.environ.get('DEBUG', '') == '1'
+logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
 # Transperth URLs
 LIVE_TIMES_URL = "https://www.transperth.wa.gov.au/Timetables/Live-Train-Times"
 API_URL = "https://www.transperth.wa.gov.au/API/SilverRailRestService/SilverRailService/GetStopTimetable"
 
+# Static headers for API calls (page tokens are added per request)
+API_HEADERS = {
+    'Accept': '*/*',
+    'Accept-Language': 'en,zh-CN;q=0.9,zh;q=0.8',
+    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'Origin': 'https://www.transperth.wa.gov.au',
+    'Referer': LIVE_TIMES_URL,
+    'X-Requested-With': 'XMLHttpRequest'
+}
+
+# Platform number in stop names, e.g. "Elizabeth Quay Stn Platform 2"
+PLATFORM_RE = re.compile(r'Platform\s+(\d+)')
+STATION_ID_RE = re.compile(r'[0-9]{1,6}')  # Transperth station ids are short numbers
+
 # Cache for tokens (so we don't fetch page every time)
 token_cache = {
     'verification_token': None,
@@ -36,112 +64,231 @@ token_cache = {
     'cookies': None,
     'timestamp': None
 }
+token_lock = threading.Lock()  # Only one thread refetches tokens at a time
 
-# Cache for departure responses (reduce API calls)
-departure_cache = {
-    'data': None,
-    'timestamp': None,
-    'station_id': None
-}
-CACHE_DURATION = 30  # Cache departures for 30 seconds
+# Cache for departure responses, keyed by station_id (reduce API calls)
+departure_cache = {}
+refreshing_stations = set()  # Stations with a background refresh running
+last_good_departures = {}  # Last successful response per station, least recently requested first
+MAX_LAST_GOOD_STATIONS = 50  # Most stations kept as a fallback (oldest dropped first)
+inflight_fetches = {}  # Pending fetch per station, shared by concurrent callers
+INFLIGHT_WAIT_TIMEOUT = 30  # Longest a caller waits on another request's fetch
+cache_lock = threading.Lock()
+CACHE_DURATION = 20  # Serve cached departures as fresh for 20 seconds
+STALE_DURATION = 60  # Then serve them for 60 more seconds while refreshing
+
+# Background refresh of recently requested stations
+REFRESH_INTERVAL = 15  # Refresh inside CACHE_DURATION so cache hits stay fresh
+IDLE_TIMEOUT = 300  # Stop refreshing a station after 5 minutes without requests
+MAX_REFRESH_STATIONS = 10  # Most stations refreshed in the background at once
+station_last_requested = {'177': time.monotonic()}  # Warm up the default station
+refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='departure-refresh')
+refresh_thread = None  # Started by the first request a serving process handles
+
+# Shared HTTP session so TCP/TLS connections to Transperth are reused
+http_session = requests.Session()
+http_session.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+})
+# Retry transient gateway errors on GETs (the token page) - POSTs are never retried.
+# Retry-After is ignored so a maintenance 503 can't stall the fetch for hours.
+http_retry = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                   raise_on_status=False, respect_retry_after_header=False)
+http_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=http_retry))
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=http_retry))
+
+def find_verification_token(response):
+    """Stream the page and stop reading as soon as the verification token is seen"""
+    # RequestVerificationToken is in a hidden input or meta tag near the top of the page
+    parser = etree.HTMLPullParser(events=('end',), tag=('input', 'meta'))
+    meta_token = None
+    try:
+        for chunk in response.iter_content(chunk_size=8192):
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                if element.get('name') != '__RequestVerificationToken':
+                    continue
+                if element.tag == 'input':
+                    return element.get('value')
+                # Keep the meta tag as a fallback in case the input comes later
+                meta_token = meta_token or element.get('content')
+    finally:
+        response.close()
+    return meta_token
 
 def fetch_page_tokens():
     """Fetch the verification token and other required values from the page"""
     try:
-        print("Fetching page tokens...")
-        session = requests.Session()
+        logger.info("Fetching page tokens...")
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-        }
-        
-        response = session.get(LIVE_TIMES_URL, headers=headers, timeout=10)
+        response = http_session.get(LIVE_TIMES_URL, timeout=10, stream=True)
         
         if response.status_code != 200:
-            print(f"Failed to fetch page: {response.status_code}")
+            logger.warning("Failed to fetch page: %s", response.status_code)
+            response.close()
             return None
         
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Find RequestVerificationToken (usually in a hidden input or meta tag)
-        token_input = soup.find('input', {'name': '__RequestVerificationToken'})
-        if token_input:
-            verification_token = token_input.get('value')
-        else:
-            # Try meta tag
-            token_meta = soup.find('meta', {'name': '__RequestVerificationToken'})
-            verification_token = token_meta.get('content') if token_meta else None
+        verification_token = find_verification_token(response)
         
         # Find ModuleId and TabId (often in script or data attributes)
         module_id = '5111'  # From your headers
         tab_id = '248'      # From your headers
         
         if verification_token:
-            print(f"✓ Got verification token: {verification_token[:20]}...")
+            logger.info("✓ Got verification token: %s...", verification_token[:20])
             return {
                 'verification_token': verification_token,
                 'module_id': module_id,
                 'tab_id': tab_id,
-                'cookies': session.cookies,
-                'timestamp': datetime.now()
+                'cookies': http_session.cookies.copy(),
+                'timestamp': time.monotonic()
             }
         else:
-            print("✗ Could not find verification token")
+            logger.warning("✗ Could not find verification token")
             return None
             
     except Exception as e:
-        print(f"Error fetching tokens: {e}")
+        logger.error("Error fetching tokens: %s", e)
         return None
 
+def tokens_are_fresh():
+    """Check if cached tokens are less than 5 minutes old"""
+    timestamp = token_cache['timestamp']
+    return timestamp is not None and time.monotonic() - timestamp < 300
+
 def get_tokens():
-    """Get tokens from cache or fetch new ones"""
-    # Check if cache is fresh (less than 5 minutes old)
-    if token_cache['timestamp']:
-        age = (datetime.now() - token_cache['timestamp']).total_seconds()
-        if age < 300:  # 5 minutes
-            return token_cache
-    
-    # Fetch new tokens
-    tokens = fetch_page_tokens()
-    if tokens:
-        token_cache.update(tokens)
+    """Get a snapshot of the cached tokens, fetching new ones if they're stale"""
+    if tokens_are_fresh():
+        return dict(token_cache)
     
-    return token_cache
+    with token_lock:
+        # Another thread may have refreshed the tokens while we waited
+        if not tokens_are_fresh():
+            tokens = fetch_page_tokens()
+            if tokens:
+                token_cache.update(tokens)
+        
+        return dict(token_cache)
 
-def calculate_minutes_until(depart_time_str):
-    """Calculate minutes until departure from ISO format time"""
+def calculate_minutes_until(depart_time_str, now):
+    """Calculate minutes until departure from ISO format time, relative to Perth time `now`"""
+    if not depart_time_str:
+        return None
+    
+    # Parse the departure time (it's in Perth timezone)
     try:
-        # Parse the departure time (it's in Perth timezone)
         depart_time = datetime.fromisoformat(depart_time_str)
-        
-        # If the departure time doesn't have timezone info, assume it's Perth time
-        if depart_time.tzinfo is None:
-            depart_time = depart_time.replace(tzinfo=PERTH_TZ)
-        
-        # Get current time in Perth timezone
-        now = datetime.now(PERTH_TZ)
-        
-        # Calculate difference
-        diff = (depart_time - now).total_seconds() / 60
-        return max(0, int(diff))
-    except Exception as e:
-        print(f"Error calculating time: {e}")
+    except (TypeError, ValueError) as e:
+        logger.warning("Error calculating time: %s", e)
         return None
+    
+    # If the departure time doesn't have timezone info, assume it's Perth time
+    if depart_time.tzinfo is None:
+        depart_time = depart_time.replace(tzinfo=PERTH_TZ)
+    
+    # Calculate difference
+    diff = (depart_time - now).total_seconds() / 60
+    return max(0, int(diff))
+
+def parse_trip(trip, now):
+    """Build a departure from an API trip (None if its departure time can't be parsed)"""
+    # Missing or null sections are treated as empty - anything else
+    # unexpected propagates to the caller
+    
+    # Get scheduled and estimated times first - trips without a usable time are
+    # skipped before any other fields are extracted
+    real_time = trip.get('RealTimeInfo') or {}
+    scheduled_time = trip.get('DepartTime') or ''
+    estimated_time = real_time.get('EstimatedDepartureTime', '')
+    
+    # Use estimated time if available, otherwise use scheduled
+    # Convert estimated time format (HH:MM:SS) to full ISO format if needed
+    if estimated_time:
+        # If estimated time is just time (no date), add the date from scheduled time
+        if 'T' not in estimated_time:
+            date_part, has_date, _ = scheduled_time.partition('T')
+            if not has_date:
+                date_part = now.strftime('%Y-%m-%d')
+            depart_time = f"{date_part}T{estimated_time}"
+        else:
+            depart_time = estimated_time
+    else:
+        depart_time = scheduled_time
+    
+    # Calculate minutes until departure (using estimated or scheduled)
+    minutes = calculate_minutes_until(depart_time, now)
+    
+    if minutes is None:
+        return None
+    
+    # Extract platform number from stop name
+    stop_name = (trip.get('StopTimetableStop') or {}).get('Name') or ''
+    platform_match = PLATFORM_RE.search(stop_name)
+    platform = platform_match.group(1) if platform_match else '?'
+    
+    # Get destination
+    summary = trip.get('Summary') or {}
+    headsign = summary.get('Headsign', '')
+    direction = summary.get('Direction', '0')  # 0 = To Perth, 1 = From Perth
+    
+    # Get display info
+    display_title = trip.get('DisplayTripTitle', '')
+    display_status = trip.get('DisplayTripStatus', '')
+    countdown = trip.get('DisplayTripStatusCountDown', '')
+    
+    # Get route info
+    route_name = summary.get('RouteName', '')
+    display_route_code = trip.get('DisplayRouteCode', '')
+    
+    # Get real-time info
+    summary_real_time = summary.get('RealTimeInfo') or {}
+    series = summary_real_time.get('Series', 'W')
+    num_cars = summary_real_time.get('NumCars', '')
+    fleet_number = summary_real_time.get('FleetNumber', '')
+    
+    # Build stops description
+    stops = f"All Stations"
+    if num_cars:
+        stops = f"{stops} ({num_cars} cars)"
+    if series:
+        stops = f"{stops} - {series} series"
+    
+    destination = display_title or headsign
+    
+    departure = {
+        'platform': platform,
+        'destination': destination,
+        'time_display': countdown or display_status,
+        'minutes': minutes,
+        'pattern': series or 'W',
+        'stops': stops,
+        'route': route_name,
+        'route_code': display_route_code,
+        'direction': direction,
+        'fleet_number': fleet_number
+    }
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        delay_status = trip.get('RealTimeStopStatusDetail', '')
+        delay_info = f" ({delay_status})" if delay_status else ""
+        logger.debug("  ✓ %s in %d min from platform %s%s", destination, minutes, platform, delay_info)
+    
+    return departure
 
 def fetch_all_departures(station_id='177'):
-    """Fetch all departures for specified station"""
+    """Fetch all departures for specified station (None if the fetch failed)"""
     try:
         # Get fresh tokens
         tokens = get_tokens()
         
         if not tokens.get('verification_token'):
-            print("No verification token available")
-            return []
+            logger.warning("No verification token available")
+            return None
         
-        # Get current date/time
-        now = datetime.now()
-        search_date = now.strftime('%Y-%m-%d')
-        search_time = now.strftime('%H:%M')
+        # Current Perth time, read once for the search and every trip in the response
+        now_perth = datetime.now(PERTH_TZ)
+        search_date = now_perth.strftime('%Y-%m-%d')
+        search_time = now_perth.strftime('%H:%M')
         
         # Prepare form data (application/x-www-form-urlencoded)
         form_data = {
@@ -152,135 +299,257 @@ def fetch_all_departures(station_id='177'):
         }
         
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'en,zh-CN;q=0.9,zh;q=0.8',
-            'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-            'Origin': 'https://www.transperth.wa.gov.au',
-            'Referer': LIVE_TIMES_URL,
-            'X-Requested-With': 'XMLHttpRequest',
+            **API_HEADERS,
             'Requestverificationtoken': tokens['verification_token'],
             'Moduleid': tokens['module_id'],
             'Tabid': tokens['tab_id']
         }
         
-        print(f"Fetching from API for station {station_id} at {search_time}...")
-        response = requests.post(
+        logger.info("Fetching from API for station %s at %s...", station_id, search_time)
+        response = http_session.post(
             API_URL,
-            data=urlencode(form_data),
+            data=form_data,
             headers=headers,
             cookies=tokens.get('cookies'),
             timeout=10
         )
         
         if response.status_code != 200:
-            print(f"API returned status {response.status_code}")
-            print(f"Response: {response.text[:500]}")
-            return []
+            logger.warning("API returned status %s: %s", response.status_code,
+                           response.content[:500].decode('utf-8', 'replace'))
+            return None
         
-        # Debug: Print response
-        print(f"API response status: {response.status_code}")
-        print(f"Response content (first 500 chars): {response.text[:500]}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API response status: %s", response.status_code)
+            logger.debug("Response content (first 500 bytes): %s",
+                         response.content[:500].decode('utf-8', 'replace'))
+        
+        # Maintenance/error pages come back as HTML with a 200 - skip the JSON parse
+        if not response.content.lstrip().startswith(b'{'):
+            logger.warning("API returned a non-JSON response: %s",
+                           response.content[:500].decode('utf-8', 'replace'))
+            return None
         
-        data = response.json()
+        # Parse the raw bytes directly - no intermediate str copy of the body
+        data = orjson.loads(response.content)
         
         if data.get('result') != 'success':
-            print(f"API result not success: {data.get('result')}")
-            print(f"Full response: {data}")
-            return []
+            logger.warning("API result not success: %s", data.get('result'))
+            logger.warning("Full response: %s", data)
+            return None
         
         trips = data.get('trips', [])
-        print(f"Found {len(trips)} trips for station {station_id}")
+        logger.info("Found %d trips for station %s", len(trips), station_id)
         
         departures = []
         
         for trip in trips:
+            # One malformed trip shouldn't throw away the whole timetable
             try:
-                # Extract platform number from stop name
-                stop_name = trip.get('StopTimetableStop', {}).get('Name', '')
-                platform_match = re.search(r'Platform\s+(\d+)', stop_name)
-                platform = platform_match.group(1) if platform_match else '?'
-                
-                # Get destination
-                summary = trip.get('Summary', {})
-                headsign = summary.get('Headsign', '')
-                direction = summary.get('Direction', '0')  # 0 = To Perth, 1 = From Perth
-                
-                # Get display info
-                display_title = trip.get('DisplayTripTitle', '')
-                display_description = trip.get('DisplayTripDescription', '')
-                display_status = trip.get('DisplayTripStatus', '')
-                countdown = trip.get('DisplayTripStatusCountDown', '')
-                
-                # Get route info
-                route_name = summary.get('RouteName', '')
-                display_route_code = trip.get('DisplayRouteCode', '')
-                
-                # Get real-time info
-                real_time = trip.get('RealTimeInfo', {})
-                series = summary.get('RealTimeInfo', {}).get('Series', 'W')
-                num_cars = summary.get('RealTimeInfo', {}).get('NumCars', '')
-                fleet_number = summary.get('RealTimeInfo', {}).get('FleetNumber', '')
-                
-                # Get scheduled and estimated times
-                scheduled_time = trip.get('DepartTime', '')
-                estimated_time = real_time.get('EstimatedDepartureTime', '')
-                
-                # Use estimated time if available, otherwise use scheduled
-                # Convert estimated time format (HH:MM:SS) to full ISO format if needed
-                if estimated_time:
-                    # If estimated time is just time (no date), add the date from scheduled time
-                    if 'T' not in estimated_time:
-                        date_part = scheduled_time.split('T')[0] if 'T' in scheduled_time else datetime.now().strftime('%Y-%m-%d')
-                        depart_time = f"{date_part}T{estimated_time}"
-                    else:
-                        depart_time = estimated_time
-                else:
-                    depart_time = scheduled_time
-                
-                # Calculate minutes until departure (using estimated or scheduled)
-                minutes = calculate_minutes_until(depart_time)
-                
-                if minutes is None:
-                    continue
-                
-                # Build stops description
-                stops = f"All Stations"
-                if num_cars:
-                    stops = f"{stops} ({num_cars} cars)"
-                if series:
-                    stops = f"{stops} - {series} series"
-                
-                # Get delay/status information for logging
-                delay_status = trip.get('RealTimeStopStatusDetail', '')
-                
-                departures.append({
-                    'platform': platform,
-                    'destination': display_title or headsign,
-                    'time_display': countdown or display_status,
-                    'minutes': minutes,
-                    'pattern': series or 'W',
-                    'stops': stops,
-                    'route': route_name,
-                    'route_code': display_route_code,
-                    'direction': direction,
-                    'fleet_number': fleet_number
-                })
-                
-                delay_info = f" ({delay_status})" if delay_status else ""
-                print(f"  ✓ {display_title or headsign} in {minutes} min from platform {platform}{delay_info}")
-                
-            except Exception as e:
-                print(f"Error parsing trip: {e}")
+                departure = parse_trip(trip, now_perth)
+            except (TypeError, AttributeError, ValueError) as e:
+                logger.warning("Skipping malformed trip: %s", e)
                 continue
+            if departure is not None:
+                departures.append(departure)
         
         return departures
         
     except Exception as e:
-        print(f"Error fetching from API: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
+        logger.exception("Error fetching from API: %s", e)
+        return None
+
+def split_soonest_departures(departures, limit=10):
+    """Split departures by direction, keeping the soonest `limit` of each, in one pass"""
+    # Bounded max-heaps of (-minutes, -index, departure) - the index keeps equal
+    # times in API order and stops ties from comparing dicts
+    heaps = {'0': [], '1': []}  # 0 = To Perth, 1 = From Perth
+    for index, d in enumerate(departures):
+        heap = heaps.get(d['direction'])
+        if heap is None:
+            continue
+        entry = (-d['minutes'], -index, d)
+        if len(heap) < limit:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+    
+    perth = [d for _, _, d in sorted(heaps['0'], reverse=True)]
+    south = [d for _, _, d in sorted(heaps['1'], reverse=True)]
+    return perth, south
+
+def build_departures(station_id):
+    """Fetch departures for a station and build the API response"""
+    logger.info("Fetching departures for station %s...", station_id)
+    
+    # Fetch all departures in one call
+    all_deps = fetch_all_departures(station_id)
+    fetched = all_deps is not None
+    
+    if not fetched:
+        # Live fetch failed - fall back to the last good response if we have one
+        with cache_lock:
+            last_good = last_good_departures.get(station_id)
+        if last_good:
+            logger.warning("✗ Live fetch failed, serving last good data for station %s", station_id)
+            return {**last_good['data'], 'stale': True}
+        all_deps = []
+    
+    logger.info("Total departures: %d", len(all_deps))
+    
+    perth, south = split_soonest_departures(all_deps)
+    
+    result = {
+        'success': True,
+        'perth': perth,
+        'south': south,
+        'station_id': station_id,
+        'last_updated': datetime.now()
+    }
+    
+    if fetched:
+        with cache_lock:
+            last_good_departures.pop(station_id, None)
+            last_good_departures[station_id] = {'data': result, 'timestamp': time.monotonic()}
+            while len(last_good_departures) > MAX_LAST_GOOD_STATIONS:
+                del last_good_departures[next(iter(last_good_departures))]
+    
+    return result
+
+def make_cache_entry(result):
+    """Serialize a departures response into a cache entry"""
+    body = orjson.dumps(result)
+    return {
+        'body': body,
+        'body_gz': gzip.compress(body, compresslevel=6),  # Compressed once, served many times
+        'timestamp': time.monotonic(),
+        'stale': bool(result.get('stale'))  # Last good data served while Transperth is down
+    }
+
+def store_departures(station_id, result):
+    """Serialize and cache a departures response, dropping entries too old to serve"""
+    entry = make_cache_entry(result)
+    now = entry['timestamp']
+    with cache_lock:
+        departure_cache[station_id] = entry
+        for key in [k for k, v in departure_cache.items()
+                    if now - v['timestamp'] >= CACHE_DURATION + STALE_DURATION]:
+            del departure_cache[key]
+    return entry
+
+def fetch_departures_coalesced(station_id):
+    """Fetch and cache departures, sharing one in-flight fetch per station"""
+    with cache_lock:
+        future = inflight_fetches.get(station_id)
+        is_owner = future is None
+        if is_owner:
+            future = inflight_fetches[station_id] = Future()
+    
+    if not is_owner:
+        # Another request is already fetching this station - wait for its result
+        logger.debug("Waiting for in-flight fetch for station %s...", station_id)
+        try:
+            return future.result(timeout=INFLIGHT_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            # Upstream is hanging - serve the last good data rather than keep waiting
+            with cache_lock:
+                last_good = last_good_departures.get(station_id)
+            if not last_good:
+                raise RuntimeError(f"Timed out waiting for departures for station {station_id}") from None
+            logger.warning("✗ In-flight fetch timed out, serving last good data for station %s", station_id)
+            return make_cache_entry({**last_good['data'], 'stale': True})
+    
+    try:
+        result = build_departures(station_id)
+        # Like the timeout path, the last-good fallback is served without being cached
+        entry = make_cache_entry(result) if result.get('stale') else store_departures(station_id, result)
+        future.set_result(entry)
+        return entry
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with cache_lock:
+            del inflight_fetches[station_id]
+
+def refresh_departures(station_id):
+    """Refresh cached departures in the background (stale-while-revalidate)"""
+    try:
+        fetch_departures_coalesced(station_id)
+    except Exception as e:
+        logger.error("Error refreshing departures for station %s: %s", station_id, e)
+    finally:
+        with cache_lock:
+            refreshing_stations.discard(station_id)
+
+def json_response(data, status=200):
+    """Build a JSON response with orjson (datetimes are serialized as ISO 8601)"""
+    return app.response_class(orjson.dumps(data), status=status, mimetype='application/json')
+
+def departures_response(entry):
+    """Build the JSON response (gzipped if accepted) with cache headers for browsers and CDNs"""
+    if request.accept_encodings['gzip']:
+        response = app.response_class(entry['body_gz'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(entry['body'], mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    
+    if entry['stale']:
+        # Fallback data - make browsers and CDNs come back for the live departures
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    # Only let downstream caches keep the entry for as long as we would
+    age = int(time.monotonic() - entry['timestamp'])
+    max_age = max(0, CACHE_DURATION - age)
+    stale_age = max(0, CACHE_DURATION + STALE_DURATION - age - max_age)
+    response.headers['Cache-Control'] = f'public, max-age={max_age}, stale-while-revalidate={stale_age}'
+    return response
+
+def track_station(station_id):
+    """Record a request for a station (enrolled for background refresh once it has good data)"""
+    with cache_lock:
+        if station_id in last_good_departures:
+            # Move to the end so the least recently requested station is evicted first
+            last_good_departures[station_id] = last_good_departures.pop(station_id)
+        if station_id in station_last_requested:
+            station_last_requested[station_id] = time.monotonic()
+        elif (station_id in last_good_departures and
+              len(station_last_requested) < MAX_REFRESH_STATIONS):
+            station_last_requested[station_id] = time.monotonic()
+
+def refresh_loop():
+    """Keep recently requested stations cached so requests never wait on Transperth"""
+    while True:
+        started = time.monotonic()
+        with cache_lock:
+            for station_id in [s for s, t in station_last_requested.items()
+                               if started - t >= IDLE_TIMEOUT]:
+                del station_last_requested[station_id]
+            stations = list(station_last_requested)
+        
+        # Refresh stations concurrently - each fetch mostly waits on the network
+        futures = {station_id: refresh_executor.submit(fetch_departures_coalesced, station_id)
+                   for station_id in stations}
+        for station_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("Error refreshing departures for station %s: %s", station_id, e)
+        
+        time.sleep(max(0, REFRESH_INTERVAL - (time.monotonic() - started)))
+
+def start_background_refresh():
+    """Start the refresh loop once per process (safe to call repeatedly)"""
+    global refresh_thread
+    with cache_lock:
+        if refresh_thread is None:
+            refresh_thread = threading.Thread(target=refresh_loop, name='departure-refresh', daemon=True)
+            refresh_thread.start()
+
+# Started lazily so importing the module (or the debug reloader's parent) makes no network calls
+app.before_request(start_background_refresh)
 
 @app.route('/api/departures', methods=['GET'])
 def get_departures():
@@ -288,63 +557,59 @@ def get_departures():
     try:
         # Get station_id from query parameter, default to 177 (Elizabeth Quay)
         station_id = request.args.get('station_id', '177')
+        if not STATION_ID_RE.fullmatch(station_id):
+            return json_response({
+                'success': False,
+                'error': 'Invalid station_id'
+            }, status=400)
         
         # Check cache first
-        now = time.time()
-        if (departure_cache['data'] and 
-            departure_cache['station_id'] == station_id and
-            now - departure_cache['timestamp'] < CACHE_DURATION):
-            
-            cache_age = int(now - departure_cache['timestamp'])
-            print(f"✓ Returning cached data for station {station_id} (age: {cache_age}s)")
-            return jsonify(departure_cache['data'])
-        
-        # Cache miss - fetch fresh data
-        print("=" * 50)
-        print(f"Fetching departures for station {station_id}...")
-        
-        # Fetch all departures in one call
-        all_deps = fetch_all_departures(station_id)
-        
-        print(f"\nTotal departures: {len(all_deps)}")
-        
-        # Separate by direction (0 = To Perth, 1 = From Perth)
-        perth = [d for d in all_deps if d.get('direction') == '0']
-        south = [d for d in all_deps if d.get('direction') == '1']
-        
-        perth.sort(key=lambda x: x['minutes'])
-        south.sort(key=lambda x: x['minutes'])
-        
-        result = {
-            'success': True,
-            'perth': perth[:10],
-            'south': south[:10],
-            'station_id': station_id,
-            'last_updated': datetime.now().isoformat()
-        }
-        
-        # Update cache
-        departure_cache['data'] = result
-        departure_cache['timestamp'] = now
-        departure_cache['station_id'] = station_id
-        
-        return jsonify(result)
+        track_station(station_id)
+        now = time.monotonic()
+        with cache_lock:
+            cached = departure_cache.get(station_id)
+            age = now - cached['timestamp'] if cached else None
+            start_refresh = (cached is not None and
+                             CACHE_DURATION <= age < CACHE_DURATION + STALE_DURATION and
+                             station_id not in refreshing_stations)
+            if start_refresh:
+                refreshing_stations.add(station_id)
+        
+        if cached and age < CACHE_DURATION:
+            logger.debug("✓ Returning cached data for station %s (age: %ds)", station_id, age)
+            return departures_response(cached)
+        
+        if cached and age < CACHE_DURATION + STALE_DURATION:
+            # Stale - serve it now and refresh in the background
+            if start_refresh:
+                refresh_executor.submit(refresh_departures, station_id)
+            logger.debug("✓ Returning stale data for station %s (age: %ds)", station_id, age)
+            return departures_response(cached)
+        
+        # Cache miss - fetch fresh data (or join a fetch already in flight)
+        entry = fetch_departures_coalesced(station_id)
+        track_station(station_id)
+        
+        return departures_response(entry)
         
     except Exception as e:
-        print(f"Error in get_departures: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({
+        logger.exception("Error in get_departures: %s", e)
+        return json_response({
             'success': False,
             'error': str(e)
-        }), 500
+        }, status=500)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check"""
-    return jsonify({
+    with cache_lock:
+        good_times = [v['timestamp'] for v in last_good_departures.values()]
+    last_good_age = int(time.monotonic() - max(good_times)) if good_times else None
+    
+    return json_response({
         'status': 'healthy',
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now(),
+        'last_good_age_seconds': last_good_age
     })
 
 @app.route('/')
@@ -371,4 +636,9 @@ if __name__ == '__main__':
     print("=" * 50)
     print("Using Transperth's official API - completely free!")
     print("=" * 50)
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Deployments run under gunicorn (see Procfile) - this is for running locally
+    if os.environ.get('FLASK_DEBUG') == '1':
+        app.run(debug=True, host='0.0.0.0', port=5000)
+    else:
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=5000, threads=8)